@@ -19,7 +19,7 @@ def read_register(client, address):
     response = client.read_holding_registers(
         address=address,
         count=2,  # Read two registers
-        slave=3   # Replace '3' with your inverter's Modbus unit ID
+        device_id=3   # Replace '3' with your inverter's Modbus unit ID
     )
     if response.isError():
         print(f"Error reading register {address}: {response}")
@@ -1,8 +1,10 @@
 import logging
-from typing import Optional, List, Union
+from typing import Optional, List, Union, Dict, Tuple
 import asyncio
-from pymodbus.client import ModbusTcpClient
-from pymodbus.constants import Endian
+import socket
+import struct
+import time
+from pymodbus.client import AsyncModbusTcpClient
 from enum import Enum
 from dataclasses import dataclass
 from sma_registers import SMA_REGISTERS, RegisterType, RegisterFormat, BATTERY_STATUS
@@ -16,17 +18,20 @@ class BatteryMode(Enum):
     @staticmethod
     def from_registers(registers):
         """Convert register values to BatteryMode"""
-        if len(registers) == 2:
-            if registers == [255, 65533]:  # Alternative NORMAL mode values
-                return BatteryMode.NORMAL
+        if not registers or len(registers) != 2:
+            return BatteryMode.NORMAL  # Default to NORMAL mode
+        # Alternative NORMAL values such as [255, 65533] fall through to the default
+        return _MODE_BY_VALUE.get(registers[1], BatteryMode.NORMAL)
 
-            mode_value = registers[1]
-            if mode_value == 802:
-                return BatteryMode.MANUAL
-            elif mode_value == 803:
-                return BatteryMode.NORMAL
+    @staticmethod
+    def power_to_registers(power: int) -> List[int]:
+        """Encode a MANUAL mode power setpoint (positive=charging) as register values"""
+        if power > 0:  # Charging
+            return [0xFFFF, (0xFFFF - power) & 0xFFFF]
+        return [0, -power & 0xFFFF]  # Discharging, or [0, 0] to pause
 
-        return BatteryMode.NORMAL  # Default to NORMAL mode
+# Low-word register value -> BatteryMode, built once at import
+_MODE_BY_VALUE = {mode.value: mode for mode in BatteryMode}
 
 @dataclass
 class BatteryStatus:
@@ -41,6 +46,14 @@ class BatteryStatus:
     solar_power_generation: int   # Solar panel power generation
     operating_status: str    # Battery operating status (Charging/Discharging/Standby/etc)
 
+# Registers read by get_battery_status on every cycle
+STATUS_REGISTERS = (
+    'battery_soc', 'total_ac_power', 'house_consumption', 'battery_power',
+    'total_dc_power', 'battery_control_mode', 'battery_charging_status'
+)
+MAX_REGISTER_GAP = 8   # Unused words allowed between registers merged into one read
+MAX_READ_COUNT = 125   # Modbus limit of registers per read request
+
 class SMAClient:
     def __init__(self, host: str, port: int = 502, unit_id: int = 3):
         self.host = host
@@ -48,21 +61,89 @@ class SMAClient:
         self.unit_id = unit_id
         self.client = None
         self.registers = SMA_REGISTERS
+        self.last_mode: Optional[BatteryMode] = None  # Last successfully written mode
+        self.last_power: Optional[int] = None         # Last successfully written power setpoint
+        self.last_mode_write: Optional[float] = None  # Monotonic time of the last mode write
+        self.mode_refresh_interval = 3600             # Re-send an unchanged mode after this many seconds
+        self.observed_mode: Optional[BatteryMode] = None  # Mode read back by the last get_battery_status
+        self._connect_lock = asyncio.Lock()
+        self._status_groups = self.group_registers(STATUS_REGISTERS)
 
     async def connect(self) -> bool:
-        """Connect to SMA inverter"""
+        """Connect to SMA inverter
+
+        Once connected, pymodbus reconnects on its own with a bounded backoff
+        if the connection drops.
+        """
         try:
-            self.client = ModbusTcpClient(self.host, port=self.port)
-            return self.client.connect()
+            self.client = AsyncModbusTcpClient(
+                self.host,
+                port=self.port,
+                timeout=2,
+                retries=3,
+                reconnect_delay=0.5,
+                reconnect_delay_max=5,
+                trace_connect=self._on_connection_change
+            )
+            if not await self.client.connect():
+                self.client.close()
+                self.client = None
+                return False
+            return True
         except Exception as e:
             logger.error(f"Error connecting to SMA: {e}")
+            self.client = None
             return False
 
+    def _on_connection_change(self, connected: bool):
+        """pymodbus callback for every (re)connect and disconnect"""
+        if connected:
+            self._configure_socket()
+        else:
+            # The inverter may have rebooted or been changed meanwhile - rewrite the mode
+            self.last_mode = self.last_power = None
+
+    def _configure_socket(self):
+        """Tune the Modbus socket for small request/response frames
+
+        TCP_NODELAY stops Nagle's algorithm from holding back the short Modbus
+        frames, and keepalive detects a silently dropped inverter connection.
+        """
+        # pymodbus >= 3.8 keeps the transport on the transaction manager (client.ctx)
+        transport = getattr(getattr(self.client, 'ctx', self.client), 'transport', None)
+        sock = transport.get_extra_info('socket') if transport else None
+        if sock is None:
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):  # Not available on every platform
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+
+    async def ensure_connected(self) -> bool:
+        """Create the connection on first use
+
+        Concurrent callers share a single connect attempt. Dropped connections
+        are re-established by pymodbus itself, so no per-read check is needed.
+        """
+        # The client is assigned before its connect() completes - callers that arrive
+        # during the first connect must wait on the lock instead of reading early
+        if self.client is not None and self.client.connected:
+            return True
+        async with self._connect_lock:
+            # Another caller may have connected while we waited for the lock
+            if self.client is not None:
+                return True
+            if not await self.connect():
+                logger.error("Failed to connect to SMA client")
+                return False
+            return True
+
     async def disconnect(self):
         """Disconnect from SMA inverter"""
         try:
-            if self.client and self.client.connected:
+            if self.client:
                 self.client.close()
+                self.client = None
                 logger.debug("Disconnected from SMA inverter")
         except Exception as e:
             logger.error(f"Error disconnecting from SMA: {e}")
@@ -70,40 +151,100 @@ class SMAClient:
     async def read_registers(self, register_addr: int, count: int = 2) -> Optional[List[int]]:
         """Read registers with proper error handling"""
         try:
-            if not self.client or not self.client.connected:
-                if not await self.connect():
-                    logger.error("Failed to connect to SMA client")
-                    return None
+            if not await self.ensure_connected():
+                return None
 
-            logger.debug(f"Reading register {register_addr} with count {count}")
+            logger.debug("Reading register %s with count %s", register_addr, count)
 
             # Calculate base address based on register range
             if register_addr < 40000:
                 base_address = register_addr
-                result = self.client.read_input_registers(
+                result = await self.client.read_input_registers(
                     address=base_address,
                     count=count,
-                    slave=self.unit_id
+                    device_id=self.unit_id
                 )
             else:
                 base_address = register_addr
-                result = self.client.read_holding_registers(
+                result = await self.client.read_holding_registers(
                     address=base_address,
                     count=count,
-                    slave=self.unit_id
+                    device_id=self.unit_id
                 )
 
             if result and not result.isError():
-                logger.debug(f"Successfully read register {register_addr}: {result.registers}")
+                logger.debug("Successfully read register %s: %s", register_addr, result.registers)
                 return result.registers
             else:
-                logger.error(f"Error reading register {register_addr}: {result}")
+                logger.error("Error reading register %s: %s", register_addr, result)
                 return None
 
         except Exception as e:
             logger.error(f"Error reading register {register_addr}: {e}")
             return None
 
+    def group_registers(self, names) -> List[Tuple[int, int, Dict[str, int]]]:
+        """Cluster registers into (start, count, {name: offset}) read requests
+
+        Registers of the same kind (input/holding) that are at most MAX_REGISTER_GAP
+        words apart are merged into one read of up to MAX_READ_COUNT words.
+        """
+        groups = []
+        for name in sorted(names, key=lambda n: self.registers[n].address):
+            register = self.registers[name]
+            end = register.address + register.count
+            if groups:
+                start, count, offsets = groups[-1]
+                if ((start < 40000) == (register.address < 40000) and
+                        register.address - (start + count) <= MAX_REGISTER_GAP and
+                        end - start <= MAX_READ_COUNT):
+                    offsets[name] = register.address - start
+                    groups[-1] = (start, max(count, end - start), offsets)
+                    continue
+            groups.append((register.address, register.count, {name: 0}))
+        return groups
+
+    async def read_register_groups(self, groups) -> Dict[str, Optional[List[int]]]:
+        """Read all register groups and slice out the raw values per register
+
+        pymodbus serializes requests on a connection behind its own lock, so the
+        groups still go out one after another - merging registers into fewer
+        groups is what saves round trips, not the gather.
+        """
+        results = await asyncio.gather(*(self.read_registers(start, count) for start, count, _ in groups))
+        values = {}
+        for (start, count, offsets), raw_values in zip(groups, results):
+            for name, offset in offsets.items():
+                values[name] = (
+                    raw_values[offset:offset + self.registers[name].count] if raw_values else None
+                )
+        return values
+
+    async def write_registers(self, register_addr: int, values: List[int]) -> bool:
+        """Write consecutive registers in a single transaction (function code 0x10)"""
+        try:
+            if not await self.ensure_connected():
+                return False
+
+            logger.debug("Writing register %s: %s", register_addr, values)
+
+            result = await self.client.write_registers(
+                address=register_addr,
+                values=values,
+                device_id=self.unit_id
+            )
+
+            if result and not result.isError():
+                logger.debug("Successfully wrote register %s", register_addr)
+                return True
+            else:
+                logger.error("Error writing register %s: %s", register_addr, result)
+                return False
+
+        except Exception as e:
+            logger.error(f"Error writing register {register_addr}: {e}")
+            return False
+
     def decode_u16(self, registers):
         """Decode unsigned 16-bit integer from register"""
         try:
@@ -128,58 +269,46 @@ class SMAClient:
             logger.error(f"Error decoding s16 value: {e}")
             return 0
 
-    def decode_u32(self, registers):
-        """Decode unsigned 32-bit integer from two registers"""
+    @staticmethod
+    def decode_u32(registers):
+        """Decode unsigned 32-bit integer from two registers (big-endian word order)"""
         try:
             if not registers or len(registers) != 2:
                 return 0
-            return self.client.convert_from_registers(
-                registers,
-                self.client.DATATYPE.UINT32,
-                word_order=Endian.BIG
-            )
+            return struct.unpack('>I', struct.pack('>HH', registers[0], registers[1]))[0]
         except Exception as e:
             logger.error(f"Error decoding u32 value: {e}")
             return 0
 
-    def decode_s32(self, registers):
-        """Decode signed 32-bit integer from two registers"""
+    @staticmethod
+    def decode_s32(registers):
+        """Decode signed 32-bit integer from two registers (big-endian word order)"""
         try:
             if not registers or len(registers) != 2:
                 return 0
-            return self.client.convert_from_registers(
-                registers,
-                self.client.DATATYPE.INT32,
-                word_order=Endian.BIG
-            )
+            return struct.unpack('>i', struct.pack('>HH', registers[0], registers[1]))[0]
         except Exception as e:
             logger.error(f"Error decoding s32 value: {e}")
             return 0
 
-    def decode_u64(self, registers):
-        """Decode unsigned 64-bit integer from four registers"""
+    @staticmethod
+    def decode_u64(registers):
+        """Decode unsigned 64-bit integer from four registers (big-endian word order)"""
         try:
             if not registers or len(registers) != 4:
                 return 0
-            return self.client.convert_from_registers(
-                registers,
-                self.client.DATATYPE.UINT64,
-                word_order=Endian.BIG
-            )
+            return struct.unpack('>Q', struct.pack('>HHHH', *registers))[0]
         except Exception as e:
             logger.error(f"Error decoding u64 value: {e}")
             return 0
 
-    def decode_s64(self, registers):
-        """Decode signed 64-bit integer from four registers"""
+    @staticmethod
+    def decode_s64(registers):
+        """Decode signed 64-bit integer from four registers (big-endian word order)"""
         try:
             if not registers or len(registers) != 4:
                 return 0
-            return self.client.convert_from_registers(
-                registers,
-                self.client.DATATYPE.INT64,
-                word_order=Endian.BIG
-            )
+            return struct.unpack('>q', struct.pack('>HHHH', *registers))[0]
         except Exception as e:
             logger.error(f"Error decoding s64 value: {e}")
             return 0
@@ -239,23 +368,20 @@ class SMAClient:
     async def get_battery_status(self) -> Optional[BatteryStatus]:
         """Get current battery system status"""
         try:
-            # Read raw register values using new register names
-            soc_registers = await self.read_registers(self.registers['battery_soc'].address)
-            grid_registers = await self.read_registers(self.registers['total_ac_power'].address)  # Changed from grid_power
-            house_registers = await self.read_registers(self.registers['house_consumption'].address)
-            battery_registers = await self.read_registers(self.registers['battery_power'].address)
-            pv_registers = await self.read_registers(self.registers['total_dc_power'].address)    # Changed from dc_power_a
-            mode_registers = await self.read_registers(self.registers['battery_control_mode'].address)
-            battery_status_registers = await self.read_registers(self.registers['battery_charging_status'].address)
+            # Read raw register values, adjacent registers share one request
+            raw = await self.read_register_groups(self._status_groups)
+            soc_registers = raw['battery_soc']
+            grid_registers = raw['total_ac_power']  # Changed from grid_power
+            house_registers = raw['house_consumption']
+            battery_registers = raw['battery_power']
+            pv_registers = raw['total_dc_power']    # Changed from dc_power_a
+            mode_registers = raw['battery_control_mode']
+            battery_status_registers = raw['battery_charging_status']
 
             # Debug logging for raw values
-            if logger.getEffectiveLevel() <= logging.DEBUG:
-                logger.debug(f"Raw SOC registers: {soc_registers}")
-                logger.debug(f"Raw grid registers: {grid_registers}")
-                logger.debug(f"Raw house registers: {house_registers}")
-                logger.debug(f"Raw battery registers: {battery_registers}")
-                logger.debug(f"Raw PV registers: {pv_registers}")
-                logger.debug(f"Raw battery status registers: {battery_status_registers}")
+            logger.debug("Raw registers - SOC: %s, grid: %s, house: %s, battery: %s, PV: %s, battery status: %s",
+                         soc_registers, grid_registers, house_registers,
+                         battery_registers, pv_registers, battery_status_registers)
 
             # Convert raw values
             soc = self.decode_u32(soc_registers) if soc_registers else 0
@@ -268,22 +394,18 @@ class SMAClient:
             battery_status = "Unknown"
             if battery_status_value in BATTERY_STATUS:
                 battery_status = BATTERY_STATUS[battery_status_value]
-                logger.debug(f"Battery Status: {battery_status}")
+                logger.debug("Battery Status: %s", battery_status)
 
             # Get PV power (now using total DC power)
             pv_power = self.decode_s32(pv_registers) if pv_registers else 0
 
             # Get current operation mode
             current_mode = BatteryMode.from_registers(mode_registers) if mode_registers else BatteryMode.NORMAL
+            self.observed_mode = current_mode if mode_registers else None
 
             # Debug logging for decoded values
-            if logger.getEffectiveLevel() <= logging.DEBUG:
-                logger.debug(f"Decoded SOC: {soc}%")
-                logger.debug(f"Decoded grid power: {grid_power}W")
-                logger.debug(f"Decoded house power: {house_power}W")
-                logger.debug(f"Decoded battery power: {battery_power}W")
-                logger.debug(f"Decoded PV power: {pv_power}W")
-                logger.debug(f"Battery operating status: {battery_status}")
+            logger.debug("Decoded - SOC: %s%%, grid: %sW, house: %sW, battery: %sW, PV: %sW, status: %s",
+                         soc, grid_power, house_power, battery_power, pv_power, battery_status)
 
             return BatteryStatus(
                 state_of_charge=soc,
@@ -313,8 +435,23 @@ class SMAClient:
                   Only used when mode is MANUAL
         """
         try:
-            logger.info(f"Setting battery to {mode.name} mode" +
-                       (f" with {power}W" if mode == BatteryMode.MANUAL else ""))
+            if mode != BatteryMode.MANUAL:
+                power = 0
+            # Skip only if the inverter still reports the mode we wrote last - another
+            # process or a reboot may have changed it since
+            if ((mode, power) == (self.last_mode, self.last_power) and
+                    self.observed_mode == mode and
+                    time.monotonic() - self.last_mode_write < self.mode_refresh_interval):
+                if mode == BatteryMode.MANUAL:
+                    logger.debug("Battery already in %s mode with %dW - skipping write", mode.name, power)
+                else:
+                    logger.debug("Battery already in %s mode - skipping write", mode.name)
+                return True
+
+            if mode == BatteryMode.MANUAL:
+                logger.info("Setting battery to %s mode with %dW", mode.name, power)
+            else:
+                logger.info("Setting battery to %s mode", mode.name)
 
             # Get register definitions
             mode_register = self.registers['battery_control_mode']
@@ -322,45 +459,31 @@ class SMAClient:
 
             # Set mode values
             mode_values = [0, mode.value]
-            mode_address = mode_register.address
-
-            mode_result = self.client.write_registers(
-                address=mode_address,
-                values=mode_values,
-                slave=self.unit_id
-            )
-
-            if mode_result.isError():
-                logger.error(f"Failed to set mode: {mode_result}")
+            if not await self.write_registers(mode_register.address, mode_values):
+                logger.error("Failed to set mode %s", mode.name)
+                # Only the failure path pays for a read-back, to show what the inverter kept
+                current = await self.read_registers(mode_register.address, mode_register.count)
+                if current:
+                    logger.error("Battery control mode register reads %s (%s)",
+                                 current, BatteryMode.from_registers(current).name)
                 return False
 
-            # Set power if in MANUAL mode
+            # Set power if in MANUAL mode; the mode write has already been acknowledged
             if mode == BatteryMode.MANUAL:
-                await asyncio.sleep(1)  # Brief delay between writes
-
-                # Convert power value to register values
-                if power > 0:  # Charging
-                    power_values = [65535, 65535 - power]
-                elif power < 0:  # Discharging
-                    power_values = [0, abs(power)]
-                else:  # Pause
-                    power_values = [0, 0]
-
-                power_address = power_register.address
-                power_result = self.client.write_registers(
-                    address=power_address,
-                    values=power_values,
-                    slave=self.unit_id
-                )
-
-                if power_result.isError():
-                    logger.error(f"Failed to set power: {power_result}")
+                power_values = BatteryMode.power_to_registers(power)
+                if not await self.write_registers(power_register.address, power_values):
+                    logger.error("Failed to set power %dW", power)
                     return False
 
-            logger.info(f"Successfully set battery to {mode.name} mode" +
-                       (f" with {power}W" if mode == BatteryMode.MANUAL else ""))
+            self.last_mode, self.last_power = mode, power
+            self.observed_mode = mode
+            self.last_mode_write = time.monotonic()
+            if mode == BatteryMode.MANUAL:
+                logger.info("Successfully set battery to %s mode with %dW", mode.name, power)
+            else:
+                logger.info("Successfully set battery to %s mode", mode.name)
             return True
 
         except Exception as e:
-            logger.error(f"Error setting battery mode: {e}", exc_info=True)
+            logger.error("Error setting battery mode: %s", e, exc_info=True)
             return False
\ No newline at end of file
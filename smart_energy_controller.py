@@ -1,13 +1,16 @@
 import asyncio
+import bisect
 import logging
 from datetime import datetime, timedelta
 from typing import Optional, Dict, List
-from enum import IntEnum
+from enum import Enum, IntEnum
 import os
-import argparse
+import signal
+import sys
+import time
+from types import SimpleNamespace
+from dotenv import load_dotenv
 from sma_client import SMAClient, BatteryMode, BatteryStatus
-from tibber_client import TibberClient
-import aiohttp
 
 # Create logger
 logger = logging.getLogger(__name__)
@@ -18,6 +21,15 @@ class DebugLevel(IntEnum):
     DETAILED = 2  # Detailed debug info
     TRACE = 3   # Full trace with register values
 
+class ControllerState(Enum):
+    NORMAL = "normal"   # Inverter runs its own automatic battery management
+    CHARGE = "charge"   # Battery is charged from the grid in manual mode
+    PAUSE = "pause"     # Battery held idle in manual mode (0W)
+
+# Relative price position (0 = minimum, 1 = maximum) bucket edges and their labels
+_PRICE_LEVEL_BINS = (0.2, 0.4, 0.6, 0.8)
+_PRICE_LEVEL_LABELS = ('BEST', 'GOOD', 'MEDIUM', 'HIGH', 'PEAK')
+
 # Setup logging
 def setup_logging(debug_level: int):
     """Configure logging based on debug level"""
@@ -55,12 +67,26 @@ class SmartEnergyController:
         self.max_charge_level = 95    # Maximum charge level to preserve battery life
         self.optimal_charge_level = 80 # Optimal charge level for daily operation
         self.max_charging_power = 2500 # Default charging power (W)
+        self.cycle_interval = 300      # Optimization cycle interval (s)
 
         # Price thresholds in €/kWh
         self.price_threshold_very_low = 0.16
         self.price_threshold_low = 0.20
         self.price_threshold_normal = 0.25
 
+        # Mode switching hysteresis to avoid flipping modes every cycle
+        self.soc_hysteresis = 3                      # SoC margin (%) before leaving a charging state
+        self.window_score_enter = 0.35               # Window score required to start window charging
+        self.window_score_exit = 0.5                 # Window score above which window charging stops
+        self.min_mode_dwell = timedelta(minutes=15)  # Minimum time between state changes
+        self.current_state: Optional[ControllerState] = None
+        self.last_mode_change: Optional[datetime] = None
+
+        # Skip battery writes while the decision inputs stay the same
+        self.decision_ttl = 900                      # Maximum age (s) of a memoized decision
+        self._last_decision_key: Optional[tuple] = None
+        self._last_decision_time = 0.0
+
         # Initialize clients
         self.sma = SMAClient(
             host=os.getenv('SMA_MODBUS_HOST', '192.168.178.57'),
@@ -68,121 +94,189 @@ class SmartEnergyController:
             unit_id=int(os.getenv('SMA_MODBUS_UNIT_ID', '3'))
         )
 
-        self.tibber = TibberClient(
-            api_token=os.getenv('TIBBER_API_KEY')
-        )
+        self._tibber = None  # Created on first use, one-shot CLI commands never need it
 
         # GO-E Configuration
         self.goe_host = os.getenv('GOE_HOST', '192.168.178.59')
+        self._http = None  # Shared aiohttp session, created on first use
+
+    @property
+    def tibber(self):
+        """Tibber price client, imported and created lazily"""
+        if self._tibber is None:
+            from tibber_client import TibberClient
+            self._tibber = TibberClient(
+                api_token=os.getenv('TIBBER_API_KEY')
+            )
+        return self._tibber
+
+    async def _get_session(self):
+        """Get the shared HTTP session for local device requests"""
+        if self._http is None or self._http.closed:
+            import aiohttp
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=8, keepalive_timeout=300, ttl_dns_cache=600),
+                # Local LAN devices answer quickly - don't let a stalled charger hold up the cycle
+                timeout=aiohttp.ClientTimeout(total=2, connect=0.5)
+            )
+        return self._http
+
+    async def aclose(self):
+        """Close the HTTP sessions held by the controller and the Tibber client"""
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+        if self._tibber is not None:
+            await self._tibber.close()
 
     async def get_car_charging_status(self) -> bool:
         """Get GO-E charger status"""
+        import orjson
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"http://{self.goe_host}/api/status") as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return data.get('car', 0) == 2
-                    return False
+            session = await self._get_session()
+            async with session.get(f"http://{self.goe_host}/api/status") as response:
+                if response.status == 200:
+                    data = orjson.loads(await response.read())
+                    return data.get('car', 0) == 2
+                return False
         except Exception as e:
             logger.error(f"Error getting GO-E status: {e}")
             return False
 
-    def find_best_charging_window(self, prices: List[Dict], hours_needed: int = 4) -> Dict:
-        """Find best charging window based on relative price levels"""
+    async def apply_battery_state(self, state: ControllerState, power: int = 0, force: bool = False,
+                                  decision_inputs: Optional[tuple] = None) -> bool:
+        """Switch the battery to a controller state, honouring the minimum dwell time
+
+        Args:
+            state: Target controller state
+            power: Charging power in watts, only used for ControllerState.CHARGE
+            force: Bypass the dwell time (car charging, emergency charging)
+            decision_inputs: Coarse inputs the decision was based on; the write is skipped
+                when state and inputs match the last successful write within decision_ttl
+        """
+        decision_key = (state, *decision_inputs) if decision_inputs is not None else None
+        if (decision_key is not None and decision_key == self._last_decision_key
+                and time.monotonic() - self._last_decision_time < self.decision_ttl):
+            logger.info("Decision inputs unchanged - keeping %s state", state.name)
+            return True
+
+        now = datetime.now()
+        if (state != self.current_state and not force and self.last_mode_change
+                and now - self.last_mode_change < self.min_mode_dwell):
+            logger.info("Keeping %s state - minimum dwell time not reached (requested %s)",
+                        self.current_state.name, state.name)
+            return False
+
+        if state == ControllerState.CHARGE:
+            success = await self.sma.set_battery_mode(BatteryMode.MANUAL, power)
+        elif state == ControllerState.PAUSE:
+            success = await self.sma.set_battery_mode(BatteryMode.MANUAL, 0)
+        else:
+            success = await self.sma.set_battery_mode(BatteryMode.NORMAL)
+
+        if success and state != self.current_state:
+            self.current_state = state
+            self.last_mode_change = now
+        if success:
+            self._last_decision_key = decision_key
+            self._last_decision_time = time.monotonic()
+        return success
+
+    def find_best_charging_window(self, prices: List[Dict], now: datetime, hours_needed: int = 4) -> Dict:
+        """Find best charging window after now based on relative price levels"""
+        import numpy as np
         try:
             if not prices:
                 logger.warning("No price data available")
                 return None
 
-            now = datetime.now().astimezone()
-            future_prices = [
-                p for p in prices
-                if datetime.fromisoformat(p['startsAt']).astimezone() > now
-            ]
+            # Prices are sorted by start time, so the remaining ones are a suffix. It starts
+            # with the running hour so a window that has already begun can still be picked
+            # (and kept) by optimize_charging
+            price_starts = [p['_ts'] for p in prices]
+            future_prices = prices[max(bisect.bisect_right(price_starts, now) - 1, 0):]
 
             if len(future_prices) < hours_needed:
                 logger.warning(f"Not enough future prices ({len(future_prices)} hours) for analysis")
                 return None
 
             # Calculate price statistics for relative comparison
-            price_values = [float(p['total']) for p in future_prices]
-            avg_price = sum(price_values) / len(price_values)
-            min_price = min(price_values)
-            max_price = max(price_values)
+            price_array = np.fromiter((p['_total'] for p in future_prices),
+                                      dtype=np.float64, count=len(future_prices))
+            avg_price = float(price_array.mean())
+            min_price = float(price_array.min())
+            max_price = float(price_array.max())
             price_range = max_price - min_price
 
             # Log price overview
-            logger.info("\nPrice Overview:")
-            logger.info(f"Average: {avg_price*100:.1f} cents/kWh")
-            logger.info(f"Minimum: {min_price*100:.1f} cents/kWh")
-            logger.info(f"Maximum: {max_price*100:.1f} cents/kWh")
-            logger.info(f"Range: {price_range*100:.1f} cents/kWh")
-
-            # Log all future prices with relative comparison
-            logger.info("\nFuture Price Analysis:")
-            for price in future_prices:
-                time = datetime.fromisoformat(price['startsAt']).strftime('%H:%M')
-                price_value = float(price['total'])
-                relative_position = (price_value - min_price) / price_range if price_range > 0 else 0
-                relative_str = "BEST" if relative_position < 0.2 else (
-                    "GOOD" if relative_position < 0.4 else (
-                    "MEDIUM" if relative_position < 0.6 else (
-                    "HIGH" if relative_position < 0.8 else "PEAK")))
-
-                logger.info(
-                    f"{time} - {price_value*100:.1f} cents/kWh "
-                    f"({relative_str}, {relative_position*100:.0f}% above min)"
-                )
+            logger.info(
+                "\nPrice Overview:\nAverage: %.1f cents/kWh\nMinimum: %.1f cents/kWh\n"
+                "Maximum: %.1f cents/kWh\nRange: %.1f cents/kWh",
+                avg_price*100, min_price*100, max_price*100, price_range*100
+            )
 
-            # Find best consecutive window based on relative prices
-            best_window = None
-            best_score = float('inf')  # Lower is better
-
-            for i in range(len(future_prices) - hours_needed + 1):
-                window = future_prices[i:i + hours_needed]
-                window_prices = [float(p['total']) for p in window]
-                avg_window_price = sum(window_prices) / len(window_prices)
-
-                # Score based on:
-                # 1. How close to minimum price (weighted 60%)
-                # 2. Price stability in window (weighted 40%)
-                price_position = (avg_window_price - min_price) / price_range if price_range > 0 else 0
-                price_stability = (max(window_prices) - min(window_prices)) / price_range if price_range > 0 else 0
-                window_score = 0.6 * price_position + 0.4 * price_stability
-
-                start_time = datetime.fromisoformat(window[0]['startsAt'])
-                end_time = datetime.fromisoformat(window[-1]['startsAt']) + timedelta(hours=1)
-
-                logger.debug(
-                    f"Window {start_time.strftime('%H:%M')}-{end_time.strftime('%H:%M')}: "
-                    f"avg={avg_window_price*100:.1f} cents/kWh, "
-                    f"score={window_score:.2f} "
-                    f"(position={price_position:.2f}, stability={price_stability:.2f})"
+            # Per-price and per-window details are only built for DETAILED debugging
+            log_details = self.debug_level >= DebugLevel.DETAILED and logger.isEnabledFor(logging.DEBUG)
+
+            # Log all future prices with relative comparison as one record
+            if log_details:
+                if price_range > 0:
+                    relative_positions = (price_array - min_price) / price_range
+                else:
+                    relative_positions = np.zeros(len(price_array))
+                labels = np.asarray(_PRICE_LEVEL_LABELS)[np.digitize(relative_positions, _PRICE_LEVEL_BINS)]
+                lines = ["\nFuture Price Analysis:"]
+                lines.extend(
+                    f"{price['_ts'].strftime('%H:%M')} - {price_value*100:.1f} cents/kWh "
+                    f"({label}, {relative_position*100:.0f}% above min)"
+                    for price, price_value, label, relative_position
+                    in zip(future_prices, price_array, labels, relative_positions)
                 )
+                logger.debug("\n".join(lines))
+
+            # Score all consecutive windows at once based on:
+            # 1. How close to minimum price (weighted 60%)
+            # 2. Price stability in window (weighted 40%)
+            windows = np.lib.stride_tricks.sliding_window_view(price_array, hours_needed)
+            window_averages = windows.mean(axis=1)
+            if price_range > 0:
+                price_positions = (window_averages - min_price) / price_range
+                price_stabilities = np.ptp(windows, axis=1) / price_range
+            else:
+                price_positions = price_stabilities = np.zeros(len(windows))
+            window_scores = 0.6 * price_positions + 0.4 * price_stabilities
+
+            if log_details:
+                for i, window_score in enumerate(window_scores):
+                    start_time = future_prices[i]['_ts']
+                    end_time = future_prices[i + hours_needed - 1]['_ts'] + timedelta(hours=1)
+                    logger.debug(
+                        "Window %s-%s: avg=%.1f cents/kWh, score=%.2f (position=%.2f, stability=%.2f)",
+                        start_time.strftime('%H:%M'), end_time.strftime('%H:%M'),
+                        window_averages[i]*100, window_score, price_positions[i], price_stabilities[i]
+                    )
 
-                if window_score < best_score:
-                    best_score = window_score
-                    best_window = {
-                        'start_time': start_time,
-                        'end_time': end_time,
-                        'average_price': avg_window_price,
-                        'prices': window,
-                        'score': window_score,
-                        'relative_position': price_position
-                    }
-
-            if best_window:
-                logger.info("\nBest Charging Window Found:")
-                logger.info(f"Time: {best_window['start_time'].strftime('%H:%M')} - "
-                          f"{best_window['end_time'].strftime('%H:%M')}")
-                logger.info(f"Average Price: {best_window['average_price']*100:.1f} cents/kWh")
-                logger.info(f"Relative Position: {best_window['relative_position']*100:.0f}% above minimum")
-                logger.info(f"Window Score: {best_window['score']:.2f}")
-
-                return best_window
+            # Lowest score wins, the earliest window on ties
+            best = int(window_scores.argmin())
+            window = future_prices[best:best + hours_needed]
+            best_window = {
+                'start_time': window[0]['_ts'],
+                'end_time': window[-1]['_ts'] + timedelta(hours=1),
+                'average_price': float(window_averages[best]),
+                'prices': window,
+                'score': float(window_scores[best]),
+                'relative_position': float(price_positions[best])
+            }
+
+            logger.info(
+                "\nBest Charging Window Found:\nTime: %s - %s\nAverage Price: %.1f cents/kWh\n"
+                "Relative Position: %.0f%% above minimum\nWindow Score: %.2f",
+                best_window['start_time'].strftime('%H:%M'), best_window['end_time'].strftime('%H:%M'),
+                best_window['average_price']*100, best_window['relative_position']*100,
+                best_window['score']
+            )
 
-            return None
+            return best_window
 
         except Exception as e:
             logger.error(f"Error in find_best_charging_window: {e}")
@@ -194,42 +288,58 @@ class SmartEnergyController:
         try:
             logger.info("\n" + "="*50 + "\nStarting optimization cycle\n" + "="*50)
 
-            # Get current system status using the SMA client
-            battery_status = await self.sma.get_battery_status()
-            car_charging_active = await self.get_car_charging_status()
-            electricity_prices = await self.tibber.get_prices()
+            # One timestamp for the whole cycle
+            now = datetime.now().astimezone()
+
+            # Fetch inverter status, charger status and prices concurrently
+            battery_status, car_charging_active, electricity_prices = await asyncio.gather(
+                self.sma.get_battery_status(),
+                self.get_car_charging_status(),
+                self.tibber.get_prices()
+            )
 
             if not battery_status or not electricity_prices:
                 logger.error("Failed to get system status or prices")
                 return
 
             # Log current system state
-            logger.info("\nCurrent System Status:")
-            logger.info(f"Battery Charge Level: {battery_status.state_of_charge}%")
-            logger.info(f"Grid Exchange Power: {battery_status.grid_power_exchange}W")
-            logger.info(f"House Consumption: {battery_status.house_power_consumption}W")
-            logger.info(f"Solar Generation: {battery_status.solar_power_generation}W")
-            logger.info(f"Battery Mode: {battery_status.operation_mode.name}")
-            logger.info(f"Car Charging: {car_charging_active}")
+            logger.info(
+                "\nCurrent System Status:\nBattery Charge Level: %s%%\nGrid Exchange Power: %sW\n"
+                "House Consumption: %sW\nSolar Generation: %sW\nBattery Mode: %s\nCar Charging: %s",
+                battery_status.state_of_charge, battery_status.grid_power_exchange,
+                battery_status.house_power_consumption, battery_status.solar_power_generation,
+                battery_status.operation_mode.name, car_charging_active
+            )
 
             # Check if car is charging - if so, set battery to pause
             if car_charging_active:
                 logger.info("Car is charging - setting battery to PAUSE mode")
-                await self.sma.set_battery_mode(BatteryMode.PAUSE)
+                await self.apply_battery_state(ControllerState.PAUSE, force=True)
                 return
 
+            # While charging, leave the charging state only once the SoC has moved
+            # past the threshold by the hysteresis margin
+            soc = battery_status.state_of_charge
+            charging = self.current_state == ControllerState.CHARGE
+            soc_margin = self.soc_hysteresis if charging else 0
+            # SoC in 5% steps, the price hour and the car state drive every decision below;
+            # the mode the inverter reports makes an externally changed mode miss the memo
+            decision_inputs = (soc // 5, now.replace(minute=0, second=0, microsecond=0),
+                               car_charging_active, battery_status.operation_mode)
+
             # Get current price and check if it's favorable
-            now = datetime.now().astimezone()
-            current_price_data = next(
-                (p for p in electricity_prices
-                 if datetime.fromisoformat(p['startsAt']).astimezone() <= now
-                 <= datetime.fromisoformat(p['startsAt']).astimezone() + timedelta(hours=1)),
-                None
+            # Prices are hourly and sorted by start time, so the current hour is the
+            # last entry starting at or before now
+            price_starts = [p['_ts'] for p in electricity_prices]
+            i = bisect.bisect_right(price_starts, now) - 1
+            current_price_data = (
+                electricity_prices[i]
+                if i >= 0 and now <= price_starts[i] + timedelta(hours=1) else None
             )
 
             if current_price_data:
-                current_price = float(current_price_data['total'])
-                price_values = [float(p['total']) for p in electricity_prices]
+                current_price = current_price_data['_total']
+                price_values = [p['_total'] for p in electricity_prices]
                 min_price = min(price_values)
                 max_price = max(price_values)
                 price_range = max_price - min_price
@@ -237,11 +347,11 @@ class SmartEnergyController:
                 current_price_position = (current_price - min_price) / price_range if price_range > 0 else 0
                 is_current_price_favorable = current_price_position <= 0.2
 
-                logger.info(f"Current price position: {current_price_position*100:.1f}% above minimum")
+                logger.info("Current price position: %.1f%% above minimum", current_price_position*100)
 
                 should_charge_now = (
                     is_current_price_favorable and
-                    battery_status.state_of_charge < self.optimal_charge_level and
+                    soc < self.optimal_charge_level - (0 if charging else self.soc_hysteresis) and
                     not car_charging_active
                 )
 
@@ -254,8 +364,8 @@ class SmartEnergyController:
                     if battery_status.state_of_charge >= 85:
                         # Gradually reduce power from 100% to 20% between 85% and 95% SoC
                         soc_factor = 1.0 - (0.8 * (battery_status.state_of_charge - 85) / 10)
-                        logger.info(f"Reducing charging power due to high SoC ({battery_status.state_of_charge}%), "
-                                  f"factor: {soc_factor:.2f}")
+                        logger.info("Reducing charging power due to high SoC (%s%%), factor: %.2f",
+                                    battery_status.state_of_charge, soc_factor)
 
                     # Adjust power based on price position
                     price_factor = 1 - current_price_position
@@ -267,33 +377,39 @@ class SmartEnergyController:
                     charging_power = max(1000, charging_power)
 
                     logger.info(
-                        f"Starting to charge at {charging_power}W "
-                        f"(base: {base_power}W, SoC factor: {soc_factor:.2f}, "
-                        f"price factor: {price_factor:.2f})"
+                        "Starting to charge at %sW (base: %sW, SoC factor: %.2f, price factor: %.2f)",
+                        charging_power, base_power, soc_factor, price_factor
                     )
-                    await self.sma.set_battery_mode(BatteryMode.FAST_CHARGE, charging_power)
+                    await self.apply_battery_state(ControllerState.CHARGE, charging_power,
+                                                   decision_inputs=decision_inputs + (None,))
                     return
 
             # Find best charging window
-            best_window = self.find_best_charging_window(electricity_prices)
+            best_window = self.find_best_charging_window(electricity_prices, now)
             if not best_window:
                 logger.warning("No suitable charging window found")
                 return
 
             # Check if in optimal charging window
+            # Good relative price; a lower score is needed to enter than to stay
+            score_limit = self.window_score_exit if charging else self.window_score_enter
+            decision_inputs += (best_window['start_time'],)
             in_best_window = (
                 best_window['start_time'] <= now <= best_window['end_time'] and
-                best_window['score'] < 0.4  # Good relative price (among best 40% of opportunities)
+                best_window['score'] < score_limit
             )
 
             # Decision making based on relative prices and battery status
-            if battery_status.state_of_charge >= self.max_charge_level:
+            if soc >= self.max_charge_level - (0 if charging else self.soc_hysteresis):
                 logger.info("Battery sufficiently charged - switching to normal mode")
-                await self.sma.set_battery_mode(BatteryMode.NORMAL)
+                # The charge cap protects the battery, so it overrides the dwell time
+                await self.apply_battery_state(ControllerState.NORMAL, force=True,
+                                               decision_inputs=decision_inputs)
 
-            elif battery_status.state_of_charge <= self.min_charge_level:
+            elif soc <= self.min_charge_level + soc_margin:
                 logger.info("Emergency charging needed - battery below minimum")
-                await self.sma.set_battery_mode(BatteryMode.FAST_CHARGE, 1500)
+                await self.apply_battery_state(ControllerState.CHARGE, 1500, force=True,
+                                               decision_inputs=decision_inputs)
 
             elif in_best_window:
                 # Calculate optimal charging power based on price position and SoC
@@ -303,14 +419,14 @@ class SmartEnergyController:
                 power = int(base_power * (0.7 + 0.3 * power_factor))  # 70-100% of base power
 
                 logger.info(
-                    f"Charging at {power}W during optimal window "
-                    f"(price position: {best_window['relative_position']*100:.0f}% above min)"
+                    "Charging at %sW during optimal window (price position: %.0f%% above min)",
+                    power, best_window['relative_position']*100
                 )
-                await self.sma.set_battery_mode(BatteryMode.FAST_CHARGE, power)
+                await self.apply_battery_state(ControllerState.CHARGE, power, decision_inputs=decision_inputs)
 
             else:
                 logger.info("Normal operation - waiting for better prices")
-                await self.sma.set_battery_mode(BatteryMode.NORMAL)
+                await self.apply_battery_state(ControllerState.NORMAL, decision_inputs=decision_inputs)
 
             logger.info("\n" + "="*50 + "\nOptimization cycle completed\n" + "="*50)
 
@@ -329,26 +445,37 @@ class SmartEnergyController:
         logger.info(f"- Cheap price threshold: {self.price_threshold_low}€/kWh")
         logger.info("=" * 50 + "\n")
 
-        # Initial connection
-        await self.sma.connect()
+        # Schedule cycles on a monotonic deadline so the work duration does not add drift
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
 
         while True:
             try:
-                start_time = datetime.now()
-                logger.info(f"\nStarting optimization cycle at {start_time.strftime('%H:%M:%S')}")
+                start_time = time.monotonic()
+                logger.info("\nStarting optimization cycle at %s", datetime.now().strftime('%H:%M:%S'))
 
                 await self.optimize_charging()
 
-                end_time = datetime.now()
-                duration = (end_time - start_time).total_seconds()
-                logger.info(f"Cycle completed in {duration:.1f} seconds")
-                logger.info(f"Next cycle in 5 minutes")
+                duration = time.monotonic() - start_time
+                logger.info("Cycle completed in %.1f seconds, next cycle in %d minutes",
+                            duration, self.cycle_interval // 60)
 
             except Exception as e:
                 logger.error(f"Error in main loop: {e}")
                 logger.exception("Detailed error trace:")
 
-            await asyncio.sleep(300)  # Run every 5 minutes
+            deadline += self.cycle_interval
+            if deadline < loop.time():
+                # Cycle overran its slot - start the next one now instead of catching up
+                deadline = loop.time()
+
+            # Prices change on the hour - wake shortly after the boundary if it comes first
+            # and continue the cycle grid from there
+            now = datetime.now().astimezone()
+            next_hour = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+            hour_wakeup = loop.time() + (next_hour - now).total_seconds() + 2
+            deadline = min(deadline, hour_wakeup)
+            await asyncio.sleep(deadline - loop.time())
 
     async def __aenter__(self):
         """Async context manager entry"""
@@ -357,20 +484,79 @@ class SmartEnergyController:
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Async context manager exit"""
+        await self.aclose()
         await self.sma.disconnect()
 
-def parse_args():
+_BATTERY_CHOICES = frozenset({'charge', 'discharge', 'pause', 'normal'})
+_DEBUG_CHOICES = frozenset({0, 1, 2, 3})
+
+# Map command line battery arguments to battery modes and power direction
+_BATTERY_MODE = {
+    'charge': BatteryMode.MANUAL,     # Charge with specified power
+    'discharge': BatteryMode.MANUAL,  # Discharge with specified power
+    'pause': BatteryMode.MANUAL,      # Manual mode with 0 power
+    'normal': BatteryMode.NORMAL      # Normal/automatic operation
+}
+_POWER_SIGN = {'charge': 1, 'discharge': -1, 'pause': 0, 'normal': 0}
+
+def _build_arg_parser(default_debug: int):
+    """Build the argparse parser (only needed for --help and error reporting)"""
+    import argparse
     parser = argparse.ArgumentParser(description='Smart Energy Controller')
-    parser.add_argument('--debug', type=int, choices=[0, 1, 2, 3],
-                       default=int(os.getenv('DEBUG_LEVEL', '0')),
+    parser.add_argument('--debug', type=int, choices=_DEBUG_CHOICES, metavar='{0,1,2,3}',
+                       default=default_debug,
                        help='Debug level (0=None, 1=Basic, 2=Detailed, 3=Trace)')
-    parser.add_argument('--battery', type=str, choices=['charge', 'discharge', 'pause', 'normal'],
+    parser.add_argument('--battery', type=str, choices=_BATTERY_CHOICES,
+                       metavar='{charge,discharge,pause,normal}',
                        help='Force battery mode (charge/discharge/pause/normal)')
     parser.add_argument('--power', type=int, default=2000,
                        help='Power in watts for charging/discharging (default: 2000)')
     parser.add_argument('--check-registers', action='store_true',
                        help='Check and display all register values')
-    return parser.parse_args()
+    return parser
+
+def parse_args(argv: Optional[List[str]] = None) -> SimpleNamespace:
+    """Parse command line arguments
+
+    Well-formed command lines are scanned directly so one-shot --battery runs
+    skip the argparse import; --help and anything unexpected are handed to
+    argparse for its usual help and error output.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    default_debug = int(os.getenv('DEBUG_LEVEL', '0'))
+    args = SimpleNamespace(
+        debug=default_debug,
+        battery=None,
+        power=2000,
+        check_registers=False
+    )
+
+    try:
+        remaining = iter(argv)
+        for arg in remaining:
+            name, sep, value = arg.partition('=')
+            if name == '--check-registers' and not sep:
+                args.check_registers = True
+                continue
+            if name not in ('--debug', '--battery', '--power'):
+                raise ValueError(arg)
+            if not sep:
+                value = next(remaining)
+            if name == '--debug':
+                args.debug = int(value)
+                if args.debug not in _DEBUG_CHOICES:
+                    raise ValueError(value)
+            elif name == '--battery':
+                if value not in _BATTERY_CHOICES:
+                    raise ValueError(value)
+                args.battery = value
+            else:
+                args.power = int(value)
+    except (ValueError, StopIteration):
+        # Let argparse print help or a proper usage error (and exit)
+        return _build_arg_parser(default_debug).parse_args(argv)
+
+    return args
 
 async def check_registers(controller: SmartEnergyController, debug_level: int):
     """Read and display all register values"""
@@ -421,6 +607,8 @@ async def check_registers(controller: SmartEnergyController, debug_level: int):
         logger.info("\n" + "="*50)
 
 async def main():
+    # Read .env once at startup; DEBUG_LEVEL and the client settings come from it
+    load_dotenv()
     args = parse_args()
     setup_logging(args.debug)
     controller = SmartEnergyController(debug_level=args.debug)
@@ -430,32 +618,61 @@ async def main():
         return
 
     if args.battery:
-        logger.info(f"Setting battery mode to: {args.battery}")
+        logger.info("Setting battery mode to: %s", args.battery)
 
-        # Map command line arguments to battery modes
-        mode_map = {
-            'charge': (BatteryMode.MANUAL, args.power),      # Charge with specified power
-            'discharge': (BatteryMode.MANUAL, -args.power),  # Discharge with specified power
-            'pause': (BatteryMode.MANUAL, 0),               # Manual mode with 0 power
-            'normal': (BatteryMode.NORMAL, 0)              # Normal/automatic operation
-        }
-
-        mode, power = mode_map[args.battery]
+        magnitude = args.power
+        mode = _BATTERY_MODE[args.battery]
+        power = _POWER_SIGN[args.battery] * magnitude
 
         async with controller as c:
             success = await c.sma.set_battery_mode(mode, power)
             if success:
-                logger.info(f"Successfully set battery to {args.battery} mode" +
-                           (f" with {abs(power)}W" if power != 0 else ""))
+                if power != 0:
+                    logger.info("Successfully set battery to %s mode with %sW", args.battery, magnitude)
+                else:
+                    logger.info("Successfully set battery to %s mode", args.battery)
             else:
-                logger.error(f"Failed to set battery mode to {args.battery}")
+                logger.error("Failed to set battery mode to %s", args.battery)
         return
 
     # Normal operation if no battery command
-    await controller.run()
+    if sys.platform != "win32":
+        # systemd/docker stop with SIGTERM - cancel the loop so the SMA connection is closed
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    async with controller:
+        try:
+            await controller.run()
+        except asyncio.CancelledError:
+            logger.info("Shutdown requested - stopping controller")
+
+def _loop_factory():
+    """uvloop's event loop factory when available, None for the default asyncio loop"""
+    if sys.platform == "win32":
+        return None
+    try:
+        import uvloop
+    except ImportError:
+        return None  # uvloop is optional (pip install uvloop)
+    return uvloop.new_event_loop
 
 if __name__ == "__main__":
+    loop_factory = _loop_factory()
+
     try:
-        asyncio.run(main())
+        if any(arg == '--battery' or arg.startswith('--battery=') for arg in sys.argv[1:]):
+            # One-shot command: nothing is left scheduled afterwards, so skip the
+            # task cancellation and async generator shutdown done by asyncio.run
+            loop = (loop_factory or asyncio.new_event_loop)()
+            try:
+                loop.run_until_complete(main())
+            finally:
+                loop.close()
+        elif sys.version_info >= (3, 11):
+            # Pass the loop factory instead of installing a (deprecated) event loop policy
+            with asyncio.Runner(loop_factory=loop_factory) as runner:
+                runner.run(main())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
-        print("\nShutting down...")
\ No newline at end of file
+        print("\nShutting down...")
@@ -1,119 +1,159 @@
+import bisect
 import logging
 import aiohttp
-from typing import List, Dict
-from datetime import datetime
+import orjson
+from operator import itemgetter
+from typing import List, Dict, Optional, Tuple
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
+# The price query never changes, so its JSON request body is serialized once
+_PRICE_QUERY = """
+{
+  viewer {
+    homes {
+      currentSubscription{
+        priceInfo{
+          today {
+            total
+            startsAt
+            level
+          }
+          tomorrow {
+            total
+            startsAt
+            level
+          }
+        }
+      }
+    }
+  }
+}
+"""
+_PRICE_QUERY_BODY = orjson.dumps({'query': _PRICE_QUERY})
+
 class TibberClient:
     def __init__(self, api_token: str):
         self.api_token = api_token
         self.api_url = "https://api.tibber.com/v1-beta/gql"
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._price_cache: Optional[Tuple[datetime, List[Dict]]] = None  # (expiry, prices)
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Get the shared HTTP session, keeping the connection to Tibber alive between calls"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=8, keepalive_timeout=300, ttl_dns_cache=600),
+                headers={"Authorization": f"Bearer {self.api_token}",
+                         "Content-Type": "application/json"}
+            )
+        return self._session
+
+    async def close(self):
+        """Close the shared HTTP session"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @staticmethod
+    def _cache_expiry(now: datetime, has_tomorrow: bool) -> datetime:
+        """Prices change at most hourly; tomorrow's prices are published around 13:00"""
+        expiry = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        if not has_tomorrow:
+            publish_time = now.replace(hour=13, minute=15, second=0, microsecond=0)
+            if now < publish_time:
+                expiry = min(expiry, publish_time)
+        return expiry
 
     async def get_prices(self) -> List[Dict]:
-        """Get Tibber price information"""
-        query = """
-        {
-          viewer {
-            homes {
-              currentSubscription{
-                priceInfo{
-                  current {
-                    total
-                    startsAt
-                  }
-                  today {
-                    total
-                    startsAt
-                    level
-                  }
-                  tomorrow {
-                    total
-                    startsAt
-                    level
-                  }
-                }
-              }
-            }
-          }
-        }
-        """
+        """Get Tibber price information (cached until the prices can next change)"""
+        now = datetime.now().astimezone()
+        if self._price_cache and now < self._price_cache[0]:
+            logger.debug("Using cached Tibber prices")
+            return self._price_cache[1]
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.api_url,
-                    json={'query': query},
-                    headers={"Authorization": f"Bearer {self.api_token}"}
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        price_info = data['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']
-
-                        prices = []
-                        if price_info.get('today'):
-                            prices.extend(price_info['today'])
-                        if price_info.get('tomorrow'):
-                            prices.extend(price_info['tomorrow'])
-                            logger.info("Tomorrow's prices are available")
-                        else:
-                            logger.info("Tomorrow's prices are not yet available")
-
-                        return prices
+            session = await self._get_session()
+            async with session.post(
+                self.api_url,
+                data=_PRICE_QUERY_BODY
+            ) as response:
+                if response.status == 200:
+                    data = orjson.loads(await response.read())
+                    price_info = data['data']['viewer']['homes'][0]['currentSubscription']['priceInfo']
+
+                    prices = []
+                    if price_info.get('today'):
+                        prices.extend(price_info['today'])
+                    if price_info.get('tomorrow'):
+                        prices.extend(price_info['tomorrow'])
+                        logger.info("Tomorrow's prices are available")
                     else:
-                        logger.error(f"Tibber API error: {response.status}")
-                        return []
+                        logger.info("Tomorrow's prices are not yet available")
+
+                    # Parse each record once; callers use '_ts' (aware local datetime)
+                    # and '_total' (float) instead of re-parsing on every cycle
+                    for price in prices:
+                        price['_ts'] = datetime.fromisoformat(price['startsAt']).astimezone()
+                        price['_total'] = float(price['total'])
+                    # Consumers bisect on '_ts', so guarantee the order on the parsed key
+                    prices.sort(key=itemgetter('_ts'))
+
+                    if prices:
+                        self._price_cache = (self._cache_expiry(now, bool(price_info.get('tomorrow'))), prices)
+                    return prices
+                else:
+                    logger.error(f"Tibber API error: {response.status}")
+                    return []
         except Exception as e:
             logger.error(f"Error fetching Tibber prices: {e}")
             return []
 
     def find_best_charging_window(self, prices: List[Dict], hours_needed: int = 4) -> Dict:
         """Find best charging window based on relative price levels"""
+        import numpy as np
         try:
             if not prices:
                 logger.warning("No price data available")
                 return None
 
             now = datetime.now().astimezone()
-            future_prices = [
-                p for p in prices
-                if datetime.fromisoformat(p['startsAt']).astimezone() > now
-            ]
+            # Timestamps are parsed once in get_prices and the list is sorted by them,
+            # so the future prices are the suffix after now
+            price_starts = [p['_ts'] for p in prices]
+            future_prices = prices[bisect.bisect_right(price_starts, now):]
 
             if len(future_prices) < hours_needed:
                 logger.warning(f"Not enough future prices ({len(future_prices)} hours) for analysis")
                 return None
 
             # Calculate price statistics
-            price_values = [float(p['total']) for p in future_prices]
-            avg_price = sum(price_values) / len(price_values)
-            min_price = min(price_values)
-            max_price = max(price_values)
-            price_range = max_price - min_price
-
-            # Find best consecutive window
-            best_window = None
-            best_score = float('inf')
-
-            for i in range(len(future_prices) - hours_needed + 1):
-                window = future_prices[i:i + hours_needed]
-                window_prices = [float(p['total']) for p in window]
-                avg_window_price = sum(window_prices) / len(window_prices)
-
-                price_position = (avg_window_price - min_price) / price_range if price_range > 0 else 0
-                price_stability = (max(window_prices) - min(window_prices)) / price_range if price_range > 0 else 0
-                window_score = 0.6 * price_position + 0.4 * price_stability
-
-                if window_score < best_score:
-                    best_score = window_score
-                    best_window = {
-                        'start_time': datetime.fromisoformat(window[0]['startsAt']),
-                        'end_time': datetime.fromisoformat(window[-1]['startsAt']),
-                        'average_price': avg_window_price,
-                        'prices': window,
-                        'score': window_score,
-                        'relative_position': price_position
-                    }
+            price_array = np.fromiter((p['_total'] for p in future_prices),
+                                      dtype=np.float64, count=len(future_prices))
+            min_price = float(price_array.min())
+            price_range = float(price_array.max()) - min_price
+
+            # Score all consecutive windows at once, the earliest window wins on ties
+            windows = np.lib.stride_tricks.sliding_window_view(price_array, hours_needed)
+            window_averages = windows.mean(axis=1)
+            if price_range > 0:
+                price_positions = (window_averages - min_price) / price_range
+                price_stabilities = np.ptp(windows, axis=1) / price_range
+            else:
+                price_positions = price_stabilities = np.zeros(len(windows))
+            window_scores = 0.6 * price_positions + 0.4 * price_stabilities
+
+            best = int(window_scores.argmin())
+            window = future_prices[best:best + hours_needed]
+            best_window = {
+                'start_time': window[0]['_ts'],
+                'end_time': window[-1]['_ts'],
+                'average_price': float(window_averages[best]),
+                'prices': window,
+                'score': float(window_scores[best]),
+                'relative_position': float(price_positions[best])
+            }
 
             return best_window
 